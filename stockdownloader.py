@@ -1,12 +1,23 @@
 import pandas as pd 
 from arango import ArangoClient
 import yfinance as yf
-from collections import defaultdict
-from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import pandas_market_calendars as mcal
 import warnings
 import os
-import pytz
+import asyncio
+import functools
+import threading
+import time
+import shutil
+import subprocess
+import tempfile
+import json
+from io import StringIO
+import requests_cache
 from dotenv import load_dotenv
 
 warnings.simplefilter(action='ignore')
@@ -14,31 +25,60 @@ warnings.simplefilter(action='ignore')
 # Constants
 BEGINNING_DATE = '2015-01-01' # Earliest date used for downloads
 STOCKS_COLLECTION='all_stocks' # Name of the collection holding all stocks
+DOWNLOAD_CHUNK_SIZE = 200 # Max tickers per yf.download call. yfinance splits these further internally.
+MAX_DOWNLOAD_WORKERS = 8 # Concurrent yfinance downloads. Keep it low to be nice to Yahoo.
+IMPORT_BATCH_SIZE = 5000 # Documents per import_bulk HTTP request.
+CACHE_MAX_AGE = 86400 # Seconds before the cached index lists are refreshed from Wikipedia.
+ARANGOIMPORT_THREADS = 4 # Parallel arangoimport sender threads used on cold loads.
+QUEUE_SIZE = 4 # Downloaded date groups waiting to be written before downloads pause.
 
 # Global variables
-# today = pytz.UTC.localize(pd.Timestamp.now()).strftime('%Y-%m-%d')
 nyse = mcal.get_calendar('NYSE') # NYSE calendar
+wiki_session = None # HTTP cache session used only for Wikipedia. See get_wiki_session.
+wiki_session_lock = threading.Lock()
+
+def get_wiki_session():
+    """
+    Returns the HTTP cache session used only for Wikipedia. Created on first use, so importing
+    this module doesn't create the cache file. The lock keeps concurrent index fetches on one session.
+    """
+    global wiki_session
+    with wiki_session_lock:
+        if wiki_session is None:
+            wiki_session = requests_cache.CachedSession('http_cache', backend='sqlite', expire_after=CACHE_MAX_AGE)
+    return wiki_session
+
 
 def last_trading_day(nyse):
     """
     Returns the last completed trading date for NYSE
     """
-    today_utc_naive = datetime.utcnow()
+    # Market closes always fall on the hour, so the answer can only change when the UTC hour does.
+    return last_trading_day_cached(nyse, datetime.now(timezone.utc).strftime('%Y-%m-%d-%H'))
+
+
+@functools.lru_cache(maxsize=8)
+def last_trading_day_cached(nyse, hour_key):
+    """
+    Computes last_trading_day. hour_key is only used to expire the cache.
+    """
+    today_utc = pd.Timestamp(datetime.now(timezone.utc))
     
-    first_day_of_year = datetime(today_utc_naive.year, 1, 1)
-    valid_days = nyse.valid_days(start_date=first_day_of_year, end_date=today_utc_naive)
+    # Two weeks always holds at least two trading days, even around early January holidays.
+    two_weeks_ago = today_utc - timedelta(days=14)
+    valid_days = nyse.valid_days(start_date=two_weeks_ago, end_date=today_utc)
     
-    schedule_today = nyse.schedule(start_date=valid_days[-1], end_date=valid_days[-1])
+    schedule = nyse.schedule(start_date=valid_days[-2], end_date=valid_days[-1])
     
-    market_close_today_utc = schedule_today.iloc[0]['market_close']
-    if pd.Timestamp(datetime.utcnow(), tz='UTC') > market_close_today_utc:
+    market_close_today_utc = schedule.iloc[-1]['market_close']
+    if today_utc > market_close_today_utc:
         return market_close_today_utc
     else:
-        schedule_prev_day = nyse.schedule(start_date=valid_days[-2], end_date=valid_days[-2])
-        market_close_prev_day_utc = schedule_prev_day.iloc[0]['market_close']
+        market_close_prev_day_utc = schedule.iloc[-2]['market_close']
         return market_close_prev_day_utc
 
 
+@functools.lru_cache(maxsize=None)
 def next_trading_day(nyse, date_str):
     """ 
     Returns the next valid trading date for a given date.
@@ -88,11 +128,13 @@ def init_db():
     if not db.has_collection(STOCKS_COLLECTION):
             col = db.create_collection(name=STOCKS_COLLECTION)
             print(f'Created collection {STOCKS_COLLECTION}. Download will start from {BEGINNING_DATE}.')
-            col.add_hash_index(fields=['ticker', 'date'], unique=True)
             col.add_skiplist_index(fields=['ticker'], unique=False)
             col.add_skiplist_index(fields=['date'], unique=False)
     else:
          col = db.collection(STOCKS_COLLECTION)
+    # Sorted (ticker, date) index so the latest date per ticker comes straight from the index.
+    # Ensuring an index that already exists is a no-op, so older databases get it too.
+    col.add_persistent_index(fields=['ticker', 'date'], unique=True)
     return db, col
 
 
@@ -115,36 +157,53 @@ def get_tickers_list(picks='./mypicks.csv', inclusion='./inclusion_list.txt', ex
             return []
 
 
-    def get_exchanges_tickers():
+    def is_fresh(file_path):
         """
-        Get all the tickers we'll use. Downloads and stores major indexes stocks, so we don't have
-        to call them every time (we're being nice to Wikipedia).
+        True if a cached index list exists and is younger than CACHE_MAX_AGE.
         """
-        #### Russell 1000
-        R1000_filename="Russell_1000_list.gzip"
+        return os.path.exists(file_path) and time.time() - os.path.getmtime(file_path) < CACHE_MAX_AGE
 
-        try:
-            r1000_ticker_df = pd.read_parquet(R1000_filename)
-        except:
-            r1000_ticker_df = pd.read_html("https://en.wikipedia.org/wiki/Russell_1000_Index")[2]
-            r1000_ticker_df.to_parquet(R1000_filename, compression="gzip")
 
-        #### Dow Jones
-        DJI_filename="DJI_list.gzip"
+    def read_wiki_table(url, table_idx):
+        """
+        Reads a table from a Wikipedia page through the HTTP cache, so unchanged pages aren't transferred again.
+        """
+        response = get_wiki_session().get(url)
+        response.raise_for_status()
+        return pd.read_html(StringIO(response.text))[table_idx]
+
 
+    def fetch_or_read(file_path, url, table_idx):
+        """
+        Returns the stored index list if it's still fresh. Otherwise downloads it again and stores it.
+        If the download fails, a stale stored list is better than nothing.
+        """
+        if is_fresh(file_path):
+            return pd.read_parquet(file_path, dtype_backend='pyarrow')
         try:
-            dji_ticker_df = pd.read_parquet(DJI_filename)
-        except:
-            dji_ticker_df = pd.read_html("https://en.wikipedia.org/wiki/Dow_Jones_Industrial_Average")[1]
-            dji_ticker_df.to_parquet(DJI_filename, compression="gzip")
+            ticker_df = read_wiki_table(url, table_idx)
+        except Exception as e:
+            if not os.path.exists(file_path):
+                raise
+            print(f'Could not refresh {file_path} from {url}: {e}. Using the stored list.')
+            return pd.read_parquet(file_path, dtype_backend='pyarrow')
+        ticker_df.to_parquet(file_path, engine="pyarrow", compression="zstd")
+        return ticker_df.convert_dtypes(dtype_backend='pyarrow') # Same dtypes as a cache hit.
 
-        #### NASDAQ 100
-        N100_filename = "NASDAQ_100_list.gzip"
-        try:
-            n100_ticker_df = pd.read_parquet(N100_filename)
-        except:
-            n100_ticker_df = pd.read_html("https://en.wikipedia.org/wiki/Nasdaq-100")[4]
-            n100_ticker_df.to_parquet(N100_filename, compression="gzip")
+
+    def get_exchanges_tickers():
+        """
+        Get all the tickers we'll use. Downloads and stores major indexes stocks, so we don't have
+        to call them every time (we're being nice to Wikipedia). Stored lists are refreshed daily.
+        The three indexes are independent, so they are fetched concurrently.
+        """
+        with ThreadPoolExecutor(max_workers=3) as ex:
+            r1000_f = ex.submit(fetch_or_read, "Russell_1000_list.parquet", "https://en.wikipedia.org/wiki/Russell_1000_Index", 2)
+            dji_f = ex.submit(fetch_or_read, "DJI_list.parquet", "https://en.wikipedia.org/wiki/Dow_Jones_Industrial_Average", 1)
+            n100_f = ex.submit(fetch_or_read, "NASDAQ_100_list.parquet", "https://en.wikipedia.org/wiki/Nasdaq-100", 4)
+            r1000_ticker_df = r1000_f.result()
+            dji_ticker_df = dji_f.result()
+            n100_ticker_df = n100_f.result()
 
         try:
             extra = pd.read_csv(picks)['Ticker'] # mypics.csv typically comes from StockRover.
@@ -158,59 +217,49 @@ def get_tickers_list(picks='./mypicks.csv', inclusion='./inclusion_list.txt', ex
         return [s.replace('.', '-') for s in ticker_df_list]
 
     # get_tickers_list function logic starts here
-    all_tickers = read_file(inclusion) + get_exchanges_tickers()
-    exclusion_tickers = read_file(exclusion)
-    for i in exclusion_tickers:
-        try:
-            all_tickers.remove(i)
-        except:
-            pass
-    return all_tickers
+    all_tickers = set(read_file(inclusion)) | set(get_exchanges_tickers())
+    return list(all_tickers - set(read_file(exclusion)))
 
-def get_last_update(ticker, db):
+def get_last_updates(db, tickers):
     """
-    Get the latest date entry for a ticker in the DB
+    Get the latest date entry for every ticker in the DB with a single query.
+    Returns a dictionary of ticker -> latest date. Tickers not in the DB are absent.
     """
-    # AQL query to find the latest date for a given ticker
+    # AQL query to find the latest date for each of the given tickers
     aql_query = f"""
     FOR doc IN {STOCKS_COLLECTION}
-        FILTER doc.ticker == '{ticker}'
-        SORT doc.date DESC
-        LIMIT 1
-        RETURN doc.date
+        FILTER doc.ticker IN @tickers
+        COLLECT t = doc.ticker AGGREGATE d = MAX(doc.date)
+        RETURN {{ticker: t, date: d}}
     """
-    cursor = db.aql.execute(aql_query)
-    latest_date = None
-    for record in cursor:
-        latest_date = record
-        break  
-    return latest_date
+    cursor = db.aql.execute(aql_query, bind_vars={'tickers': tickers}, batch_size=10000, stream=True)
+    return {record['ticker']: record['date'] for record in cursor}
 
 
 def calculate_downloads(db, tickers):
     """
     Returns a list of dictionaries with date and the tickers to download starting on that date.
     """
-    # Internal functions
-    def anything_to_download(d):
-        return (next_trading_day(nyse, d) < last_trading_day(nyse))
+    # The last trading day is constant for the whole run, so compute it only once.
+    ltd = last_trading_day(nyse)
 
     # Main function logic starts here.
     all_dates = []
+    last_updates = get_last_updates(db, tickers)
 
     for i in tickers:
-        lu = get_last_update(i, db)
+        lu = last_updates.get(i)
         if lu != None:
-            if anything_to_download(lu):
-                all_dates.append([lu, i])
+            # Start on the day after the last one stored, so it isn't downloaded and inserted again.
+            ntd = next_trading_day(nyse, lu)
+            if ntd < ltd:
+                all_dates.append([ntd.strftime('%Y-%m-%d'), i])
         else:
             all_dates.append([BEGINNING_DATE, i])
 
-    ticker_dict = defaultdict(list)
-    for item in all_dates:
-        date, ticker = item
-        ticker_dict[date].append(ticker)
-    return [{"date": date, "tickers": tickers} for date, tickers in ticker_dict.items()]
+    # Sorted by date, so downloads are scheduled chronologically.
+    all_dates.sort(key=itemgetter(0))
+    return [{"date": date, "tickers": [t for _, t in group]} for date, group in groupby(all_dates, key=itemgetter(0))]
 
 
 def data_download(tickers=[], start=BEGINNING_DATE, interval='1d'):
@@ -218,44 +267,120 @@ def data_download(tickers=[], start=BEGINNING_DATE, interval='1d'):
     Download the tickers in the daily timeframe starting with the proper date.
     Returns a list of records ready to insert or process.
     """
+    # Internal functions
+    def to_records(df, chunk):
+        # Normalize single-ticker downloads to the same (column, ticker) layout as multi-ticker ones.
+        if not isinstance(df.columns, pd.MultiIndex):
+            df.columns = pd.MultiIndex.from_product([df.columns, [chunk[0]]])
+
+        # Reshape to one row per (date, ticker). Yahoo pads tickers with no data on a date with NaN.
+        sub = df.stack(level=1).dropna()
+        sub.index.names = ['date', 'ticker']
+        sub = sub.rename(columns={'Open': 'open', 'High': 'high', 'Low': 'low', 'Adj Close': 'close'})
+        sub = sub.reset_index()
+        sub['date'] = sub['date'].values.astype('datetime64[D]').astype(str) # Vectorized, no strftime.
+        return sub[['ticker', 'date', 'open', 'high', 'low', 'close']].to_dict('records')
+
+    # Main function logic starts here.
     if not tickers:
         return None
-    
-    try:
-        df = yf.download(tickers=tickers, start=start, interval=interval)
-    except:
-        print('Something failed in the yfinance download.')
-        return None
-    
+
+    tickers = list(dict.fromkeys(tickers)) # Drop duplicates, keeping order.
     records = []
-    dates = df.index.unique()
-    if isinstance(df.columns, pd.MultiIndex):
-        for date in dates:
-            for ticker in tickers:
-                record = {
-                    'ticker': ticker,
-                    'date': date.strftime('%Y-%m-%d'),
-                    'open': df.loc[date, ('Open', ticker)],
-                    'high': df.loc[date, ('High', ticker)],
-                    'low': df.loc[date, ('Low', ticker)],
-                    'close': df.loc[date, ('Adj Close', ticker)]
-                }
-                records.append(record)
-    else:
-        ticker = tickers[0]
-        for date in dates:
-            record = {
-                'ticker': ticker,
-                'date': date.strftime('%Y-%m-%d'),
-                'open': df.loc[date, 'Open'],
-                'high': df.loc[date, 'High'],
-                'low': df.loc[date, 'Low'],
-                'close': df.loc[date, 'Adj Close']
-            }
-            records.append(record)
+    for i in range(0, len(tickers), DOWNLOAD_CHUNK_SIZE):
+        chunk = tickers[i:i + DOWNLOAD_CHUNK_SIZE]
+        try:
+            df = yf.download(tickers=chunk, start=start, interval=interval, threads=True,
+                             auto_adjust=False, progress=False)
+        except:
+            print(f'Something failed in the yfinance download of {len(chunk)} tickers starting on {start}.')
+            continue
+        if df.empty:
+            continue
+        df = df[['Open', 'High', 'Low', 'Adj Close']] # Only keep the columns we store.
+        records.extend(to_records(df, chunk))
     return records
 
 
+def arangoimport_records(records):
+    """
+    Bulk loads records into the collection with the arangoimport binary through a temporary JSONL file.
+    Returns False if arangoimport isn't installed or fails, so the caller can fall back to import_bulk.
+    """
+    if shutil.which('arangoimport') is None:
+        return False
+
+    # Temporary files are created with 0600 permissions, so the credentials stay off the command line.
+    with tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False) as conf:
+        conf.write('[server]\n'
+                   f'endpoint = tcp://{os.environ["ADBHOST"]}:{os.environ["ADBPORT"]}\n'
+                   f'username = {os.environ["ADBUSER"]}\n'
+                   f'password = {os.environ["ADBPW"]}\n'
+                   f'database = {os.environ["ADBNAME"]}\n')
+    try:
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        try:
+            result = subprocess.run(['arangoimport',
+                                     '--configuration', conf.name,
+                                     '--file', f.name,
+                                     '--type', 'jsonl',
+                                     '--collection', STOCKS_COLLECTION,
+                                     '--on-duplicate', 'ignore',
+                                     '--threads', str(ARANGOIMPORT_THREADS)],
+                                    capture_output=True, text=True)
+        finally:
+            os.remove(f.name)
+    finally:
+        os.remove(conf.name)
+
+    if result.returncode != 0:
+        print(f'arangoimport failed, falling back to import_bulk: {result.stderr.strip()}')
+        return False
+    return True
+
+
+async def download_and_store(col, download_lists):
+    """
+    Downloads every date group concurrently and writes the records to the collection as they arrive.
+    yfinance and python-arango are synchronous, so the blocking calls run in worker threads, while
+    a single writer task keeps all DB writes sequential.
+    """
+    # Internal functions
+    async def producer(entry):
+        # The slot is held until the records are queued, so a full queue pauses new downloads.
+        async with semaphore:
+            try:
+                records = await asyncio.to_thread(data_download, tickers=entry['tickers'], start=entry['date'], interval='1d')
+            except Exception as e:
+                print(f'An error occurred while downloading {len(entry["tickers"])} tickers starting on {entry["date"]}: {e}')
+                return
+            if records:
+                await queue.put((entry['date'], records))
+
+    async def writer():
+        while (item := await queue.get()) is not None:
+            start, records = item
+            try:
+                # Tickers never downloaded before are a cold load, which arangoimport handles much faster.
+                if start == BEGINNING_DATE and await asyncio.to_thread(arangoimport_records, records):
+                    continue
+                # Re-runs may hit existing (ticker, date) pairs, so duplicates are skipped, not fatal.
+                await asyncio.to_thread(col.import_bulk, records, batch_size=IMPORT_BATCH_SIZE,
+                                        on_duplicate='ignore', halt_on_error=False, overwrite=False)
+            except Exception as e:
+                print(f'An error occurred while importing {len(records)} records: {e}')
+
+    # Main function logic starts here.
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    semaphore = asyncio.Semaphore(MAX_DOWNLOAD_WORKERS)
+    writer_task = asyncio.create_task(writer())
+    await asyncio.gather(*(producer(entry) for entry in download_lists))
+    await queue.put(None)
+    await writer_task
+
+
 def main():
     db, col = init_db()
     tickers = get_tickers_list(picks='./mypicks.csv', inclusion='./inclusion_list.txt', exclusion='./exclusion_list.txt')
@@ -264,9 +389,7 @@ def main():
     if not download_lists:
         print('Nothing to download')
     else:
-        for entry in download_lists:        
-            records = data_download(tickers=entry['tickers'], start=entry['date'], interval='1d')
-            col.import_bulk(records)
+        asyncio.run(download_and_store(col, download_lists))
 
 
 if __name__ == "__main__":